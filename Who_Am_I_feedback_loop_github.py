@@ -1,21 +1,189 @@
 import os
 import streamlit as st
+import asyncio
+import aiohttp
 import requests
+import threading
 import json
+import logging
 import base64
 import io
 import time
-import uuid
+import itertools
+import secrets
+import hashlib
+import concurrent.futures
+from types import MappingProxyType
+import numpy as np
+from urllib.parse import urlparse
+import httpx
 import replicate
+from replicate.exceptions import ModelError, ReplicateError
+from replicate.stream import ServerSentEvent
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
 from PIL import Image
 from openai import OpenAI
 
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+logger = logging.getLogger(__name__)
+
+# Set once the embedding model fails to load or encode, so it isn't retried on every call
+embedder_disabled = False
+
+# Cosine similarity above which a cached prompt expansion is reused
+SEMANTIC_CACHE_THRESHOLD = 0.92
+
+# Similarity between consecutive descriptions at which the loop stops early
+CONVERGENCE_THRESHOLD = 0.98
+
+# Read/write size when streaming images to and from disk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# LLaVA resizes to 336x336 internally, so larger uploads are wasted bandwidth
+LLAVA_UPLOAD_SIZE = (384, 384)
+
+# Per-iteration placeholders, in display order
+ITERATION_SLOTS = (
+    "title",
+    "expand_header", "expand_status", "expand_output",
+    "image_header", "image_status", "image_output",
+    "describe_header", "describe_status", "describe_output",
+    "separator",
+)
+
+# Upper bound on in-flight Replicate predictions across parallel loops
+MAX_REPLICATE_CONCURRENCY = 4
+
+# Image downloads give up after this many seconds
+DOWNLOAD_TIMEOUT = 120
+
+# Minimum seconds between UI redraws while tokens stream in
+STREAM_RENDER_INTERVAL = 0.1
+
+# Local Ollama server used for prompt expansion
+OLLAMA_URL = "http://localhost:11434"
+
+# Image models: LCM-distilled SD for few-step generation, SD 1.5 for the classic schedulers
+LCM_MODEL = "luosiallen/latent-consistency-model:553803fd018b3cf875a8bc774c99da9b33f36647badfd88a6eec90d61c5f62fc"
+SD_MODEL = "stability-ai/stable-diffusion:ac732df83cea7fff18b8472768c88ad041fa750ff7682a21affe81863cbe77e4"
+
+# Text models and their fixed prompts
+LLAMA_MODEL = "meta/llama-3-8b-instruct:2d19859030ff705a87c746f7e96eea03aefb71f166725aee39692f1476566d48"
+LLAVA_MODEL = "yorickvp/llava-13b:2facb4a474a0462c15041b78b1ad70952ea46b5ec6ad29583c0b29dbd4249591"
+EXPAND_PROMPT_PREFIX = "You are a creative prompt engineer for image generation. Expand this short prompt into a detailed and vivid scene description including style, lighting, mood, and composition. Just provide the expanded prompt without explanations: "
+DESCRIBE_PROMPT = "Describe this image in detail as if you were creating a prompt for an image generator. Be creative and focus on visual elements, style, mood, and atmosphere. Do not start with phrases like 'This image shows' or 'I can see'. Just describe the content directly."
+
+def disable_embedder(error):
+    # Fall back to exact caching and token-set convergence for the rest of the process
+    global embedder_disabled
+    if not embedder_disabled:
+        embedder_disabled = True
+        logger.warning("Embedding model unavailable, semantic features disabled: %s", error)
+
+@st.cache_resource
+def get_embedder():
+    # Small local embedding model, loaded once per process; semantic caching is skipped without it
+    if SentenceTransformer is None or embedder_disabled:
+        return None
+    try:
+        return SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+    except Exception as e:
+        disable_embedder(e)
+        return None
+
+def signature_similarity(a, b):
+    # Token-set Jaccard for the fallback signature, cosine for normalized embeddings
+    if isinstance(a, frozenset):
+        return len(a & b) / len(a | b) if a | b else 1.0
+    return float(a @ b)
+
+def write_file(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def thumbnail_jpeg(path, size=LLAVA_UPLOAD_SIZE, quality=90):
+    with Image.open(path) as image:
+        thumbnail = image.convert("RGB")
+    thumbnail.thumbnail(size, Image.LANCZOS)
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, "JPEG", quality=quality, optimize=False)
+    buffer.seek(0)
+    return buffer
+
+@st.cache_resource
+def warm_ollama(ollama_url=OLLAMA_URL):
+    # Load the prompt model once per process in the background, before the first Start click
+    def warm():
+        # One-token request with keep_alive=-1 so the model stays resident
+        try:
+            requests.post(
+                f"{ollama_url}/api/generate",
+                json={
+                    "model": "gnokit/improve-prompt",
+                    "prompt": " ",
+                    "stream": False,
+                    "keep_alive": -1,
+                    "options": {"num_predict": 1}
+                },
+                timeout=120
+            )
+        except requests.RequestException:
+            # Ollama not running; expand_prompt falls back to Replicate
+            pass
+    
+    thread = threading.Thread(target=warm, daemon=True)
+    thread.start()
+    return thread
+
+# HTTP statuses Replicate returns for rate limits and cold starts
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+def is_transient_replicate_error(error):
+    # Timeouts and overload statuses are worth retrying; auth and input errors (4xx) are not
+    if isinstance(error, httpx.TimeoutException):
+        return True
+    return isinstance(error, ReplicateError) and getattr(error, "status", None) in RETRYABLE_STATUSES
+
+replicate_retry = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=1, max=10),
+    retry=retry_if_exception(is_transient_replicate_error),
+    reraise=True,
+)
+
+async def render_stream(tokens, output_slot):
+    # Show tokens in the slot as they arrive, redrawing at most every STREAM_RENDER_INTERVAL seconds
+    parts = []
+    last_render = 0.0
+    async for token in tokens:
+        parts.append(token)
+        now = time.monotonic()
+        if output_slot is not None and now - last_render >= STREAM_RENDER_INTERVAL:
+            output_slot.markdown(f"<div class='output-area'>{''.join(parts)}</div>", unsafe_allow_html=True)
+            last_render = now
+    text = "".join(parts)
+    if output_slot is not None:
+        output_slot.markdown(f"<div class='output-area'>{text}</div>", unsafe_allow_html=True)
+    return text.strip()
+
 class FeedbackLoop:
-    def __init__(self, ollama_url="http://localhost:11434", openai_api_key=None, replicate_api_token=None, output_dir=None):
+    def __init__(self, ollama_url=OLLAMA_URL, openai_api_key=None, replicate_api_token=None, output_dir=None, steps=4, scheduler="LCM"):
         # Set up Replicate API
         self.replicate_api_token = replicate_api_token or os.environ.get("REPLICATE_API_TOKEN")
         if self.replicate_api_token:
             os.environ["REPLICATE_API_TOKEN"] = self.replicate_api_token
+        self._replicate = replicate.Client(api_token=self.replicate_api_token)
         
         # Set up OpenAI client (keeping for backwards compatibility)
         self.openai_api_key = openai_api_key
@@ -25,6 +193,35 @@ class FeedbackLoop:
         # Set up Ollama API
         self.ollama_url = ollama_url
         
+        # Image generation settings: "LCM" runs the few-step LCM model, any other
+        # scheduler name (e.g. "K_EULER_ANCESTRAL" with steps=50) runs SD 1.5
+        self.steps = steps
+        self.scheduler = scheduler
+        
+        # Constant image model inputs are built once; each call only adds prompt and seed
+        if self.scheduler == "LCM":
+            # Latent Consistency Model on Replicate - a handful of steps instead of 50.
+            # LCM has no negative_prompt input, so it is not sent.
+            self._image_model = LCM_MODEL
+            self._sd_input_template = MappingProxyType({
+                "num_inference_steps": self.steps,
+                "guidance_scale": 8.0,
+                "width": 768,
+                "height": 768,
+            })
+        else:
+            # Using Stable Diffusion on Replicate - Updated model version ID
+            self._image_model = SD_MODEL
+            self._sd_input_template = MappingProxyType({
+                "width": 768,
+                "height": 768,
+                "num_outputs": 1,
+                "scheduler": self.scheduler,
+                "num_inference_steps": self.steps,
+                "guidance_scale": 7.5,
+                "negative_prompt": "ugly, blurry, poor quality, deformed, disfigured",
+            })
+        
         # Set up output directories
         self.output_dir = output_dir or os.path.join(os.path.expanduser("~"), "feedback-loop-project", "output")
         self.images_dir = os.path.join(self.output_dir, "images")
@@ -33,149 +230,394 @@ class FeedbackLoop:
         # Create output directories if they don't exist
         os.makedirs(self.images_dir, exist_ok=True)
         os.makedirs(self.prompts_dir, exist_ok=True)
+        
+        # Image filenames: a short per-run token plus a counter, unique across runs in the same directory
+        self._run_id = secrets.token_hex(6)
+        self._seq = itertools.count()
+        
+        # Pre-joined filename prefix so the hot loop only formats a string
+        self._images_prefix = f"{os.path.join(self.images_dir, 'image_')}{self._run_id}_"
+        
+        # HTTP session and Replicate semaphore are created lazily inside the event loop
+        self._session = None
+        self._replicate_slots = None
+        
+        # Disk writes run in the background so they stay off the critical path.
+        # A single worker keeps run log lines and cache snapshots in order.
+        self._io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        
+        # Prompts and descriptions are appended to one line-buffered JSONL log per output dir
+        self._log = open(os.path.join(self.output_dir, "run.jsonl"), "a", buffering=1, encoding="utf-8")
+        
+        # Exact cache is persisted to disk, semantic cache of prompt expansions lives in memory
+        self.cache_path = os.path.join(self.prompts_dir, "cache.json")
+        self._exact_cache = self._load_cache()
+        self._semantic_matrix = None
+        self._semantic_responses = []
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            # Keep-alive pool shared by Ollama calls and image downloads
+            connector = aiohttp.TCPConnector(limit=8, limit_per_host=4)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+    
+    def _save_text(self, path, text):
+        # Write in a worker thread so the next network call isn't held up by disk I/O
+        return self._io_pool.submit(write_file, path, text)
+    
+    def log_event(self, iteration, stage, text, seed=None):
+        line = json.dumps({"iter": iteration, "seed": seed, "stage": stage, "text": text}, ensure_ascii=False) + "\n"
+        return self._io_pool.submit(self._log.write, line)
+    
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+    
+    def clear_cache(self):
+        self._exact_cache = {}
+        self._semantic_matrix = None
+        self._semantic_responses = []
+        if os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+    
+    async def _embed(self, text):
+        # Model load and encode are CPU-bound, keep them off the event loop
+        def encode():
+            if embedder_disabled:
+                return None
+            embedder = get_embedder()
+            if embedder is None:
+                return None
+            try:
+                return embedder.encode(text, normalize_embeddings=True)
+            except Exception as e:
+                disable_embedder(e)
+                return None
+        
+        return await asyncio.get_running_loop().run_in_executor(None, encode)
+    
+    async def _prompt_signature(self, text):
+        # Embedding when available, otherwise the lowercase token set
+        vector = await self._embed(text)
+        return vector if vector is not None else frozenset(text.lower().split())
+    
+    async def _cached(self, key, fn, status_placeholder, query=None):
+        # Exact hit on the SHA1 key
+        cached = self._exact_cache.get(key)
+        if cached:
+            status_placeholder.write("✅ Loaded from cache")
+            return cached
+        
+        # Semantic hit on a near-duplicate query
+        query_vector = await self._embed(query) if query is not None else None
+        if query_vector is not None and self._semantic_responses:
+            scores = np.dot(self._semantic_matrix, query_vector)
+            best = int(np.argmax(scores))
+            if scores[best] >= SEMANTIC_CACHE_THRESHOLD:
+                status_placeholder.write("✅ Loaded similar result from cache")
+                return self._semantic_responses[best]
+        
+        response = await fn()
+        
+        # Only successful, non-empty responses are cached
+        if response:
+            self._exact_cache[key] = response
+            self._save_text(self.cache_path, json.dumps(self._exact_cache, ensure_ascii=False))
+            if query_vector is not None:
+                if self._semantic_matrix is None:
+                    self._semantic_matrix = query_vector[np.newaxis, :]
+                else:
+                    self._semantic_matrix = np.vstack([self._semantic_matrix, query_vector])
+                self._semantic_responses.append(response)
+        return response
+    
+    def __del__(self):
+        log = getattr(self, "_log", None)
+        if log is not None and not log.closed:
+            self._io_pool.shutdown(wait=True)
+            log.close()
+    
+    def _get_replicate_slots(self):
+        # Bound concurrent predictions when several loops run at once
+        if self._replicate_slots is None:
+            self._replicate_slots = asyncio.Semaphore(MAX_REPLICATE_CONCURRENCY)
+        return self._replicate_slots
+    
+    # Only creation is retried, so a polling hiccup never starts a second paid prediction
+    @replicate_retry
+    async def _create_prediction(self, model, model_input, stream=False):
+        # File inputs are read during upload, rewind them in case this is a retry
+        for value in model_input.values():
+            if hasattr(value, "seek"):
+                value.seek(0)
+        
+        version = model.split(":", 1)[1]
+        return await self._replicate.predictions.async_create(version=version, input=model_input, stream=stream)
+    
+    async def _call_replicate_run(self, model, model_input):
+        # Create the prediction and wait on it without holding a thread while the model runs
+        async with self._get_replicate_slots():
+            prediction = await self._create_prediction(model, model_input)
+            await prediction.async_wait()
+        
+        if prediction.status != "succeeded":
+            raise ModelError(prediction)
+        return prediction.output
+    
+    async def _stream_replicate(self, model, model_input):
+        # Yield output tokens as the model produces them, holding a slot until the stream ends
+        async with self._get_replicate_slots():
+            prediction = await self._create_prediction(model, model_input, stream=True)
+            streamed = False
+            async for event in prediction.async_stream():
+                if event.event == ServerSentEvent.EventType.OUTPUT:
+                    streamed = True
+                    yield event.data
+            await prediction.async_reload()
+        
+        if prediction.status != "succeeded":
+            raise ModelError(prediction)
+        
+        # Don't return an empty result if the stream carried no output events
+        if not streamed and prediction.output:
+            yield "".join(prediction.output)
+    
+    async def close(self):
+        # Wait for outstanding file writes and release pooled connections
+        await asyncio.get_running_loop().run_in_executor(None, lambda: self._io_pool.shutdown(wait=True))
+        self._log.close()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
 
-    def expand_prompt(self, short_prompt, status_placeholder):
+    async def expand_prompt(self, short_prompt, status_placeholder, output_slot=None):
+        if not short_prompt:
+            status_placeholder.write("❌ No prompt to expand")
+            return short_prompt
+        
+        key = "expand:" + hashlib.sha1(short_prompt.encode("utf-8")).hexdigest()
+        expanded_prompt = await self._cached(
+            key,
+            lambda: self._expand_prompt_with_ollama(short_prompt, status_placeholder, output_slot),
+            status_placeholder,
+            query=short_prompt,
+        )
+        return expanded_prompt or short_prompt
+    
+    async def _expand_prompt_with_ollama(self, short_prompt, status_placeholder, output_slot=None):
         status_placeholder.write("Expanding the prompt...")
         
         try:
-            response = requests.post(
+            session = self._get_session()
+            async with session.post(
                 f"{self.ollama_url}/api/generate",
                 json={
                     "model": "gnokit/improve-prompt",
                     "prompt": short_prompt,
                     "stream": False
                 }
-            )
+            ) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    expanded_prompt = data.get("response", "").strip()
+                    
+                    status_placeholder.write("✅ Prompt expanded successfully")
+                    return expanded_prompt
             
-            if response.status_code == 200:
-                expanded_prompt = response.json().get("response", "").strip()
-                
-                # Save the prompt
-                prompt_path = os.path.join(self.prompts_dir, f"prompt_{uuid.uuid4()}.txt")
-                with open(prompt_path, "w", encoding="utf-8") as f:
-                    f.write(expanded_prompt)
-                
-                status_placeholder.write("✅ Prompt expanded successfully")
-                return expanded_prompt
-            else:
-                status_placeholder.write("⚠️ Error with Ollama. Falling back to Replicate...")
-                return self._expand_prompt_with_replicate(short_prompt, status_placeholder)
+            status_placeholder.write("⚠️ Error with Ollama. Falling back to Replicate...")
+            return await self._expand_prompt_with_replicate(short_prompt, status_placeholder, output_slot)
         except Exception as e:
             status_placeholder.write(f"⚠️ Exception: {str(e)}. Falling back to Replicate...")
-            return self._expand_prompt_with_replicate(short_prompt, status_placeholder)
+            return await self._expand_prompt_with_replicate(short_prompt, status_placeholder, output_slot)
     
-    def _expand_prompt_with_replicate(self, short_prompt, status_placeholder):
+    async def _expand_prompt_with_replicate(self, short_prompt, status_placeholder, output_slot=None):
         try:
-            # Using Llama 3 on Replicate for fallback prompt expansion
-            output = replicate.run(
-                "meta/llama-3-8b-instruct:2d19859030ff705a87c746f7e96eea03aefb71f166725aee39692f1476566d48",
-                input={
-                    "prompt": f"You are a creative prompt engineer for image generation. Expand this short prompt into a detailed and vivid scene description including style, lighting, mood, and composition. Just provide the expanded prompt without explanations: {short_prompt}"
-                }
-            )
-            
-            # Replicate returns output as a generator, collect all parts
-            result = ""
-            for item in output:
-                result += item
-                
-            expanded_prompt = result.strip()
-            
-            # Save the prompt
-            prompt_path = os.path.join(self.prompts_dir, f"prompt_{uuid.uuid4()}.txt")
-            with open(prompt_path, "w", encoding="utf-8") as f:
-                f.write(expanded_prompt)
+            # Using Llama 3 on Replicate for fallback prompt expansion, streamed into the UI
+            tokens = self._stream_replicate(LLAMA_MODEL, {"prompt": EXPAND_PROMPT_PREFIX + short_prompt})
+            expanded_prompt = await render_stream(tokens, output_slot)
             
             status_placeholder.write("✅ Prompt expanded with Replicate")
             return expanded_prompt
         except Exception as e:
             status_placeholder.write(f"❌ Error expanding with Replicate: {str(e)}")
-            return short_prompt
+            return None
     
-    def generate_image(self, prompt, status_placeholder):
+    async def generate_image(self, prompt, status_placeholder, seed=42):
         status_placeholder.write("Generating image from prompt using Replicate...")
         
         try:
-            # Using Stable Diffusion on Replicate - Updated model version ID
-            output = replicate.run(
-                "stability-ai/stable-diffusion:ac732df83cea7fff18b8472768c88ad041fa750ff7682a21affe81863cbe77e4",
-                input={
-                    "prompt": prompt,
-                    "width": 768,
-                    "height": 768,
-                    "num_outputs": 1,
-                    "scheduler": "K_EULER_ANCESTRAL",
-                    "num_inference_steps": 50,
-                    "guidance_scale": 7.5,
-                    "seed": 42,
-                    "negative_prompt": "ugly, blurry, poor quality, deformed, disfigured",
-                }
-            )
+            model_input = {**self._sd_input_template, "prompt": prompt, "seed": seed}
+            output = await self._call_replicate_run(self._image_model, model_input)
             
             # Output contains image URLs
             if output and len(output) > 0:
-                image_url = output[0]
+                image_url = str(output[0])
                 
-                # Download the image
-                image_response = requests.get(image_url)
-                if image_response.status_code == 200:
-                    image = Image.open(io.BytesIO(image_response.content))
-                    
-                    # Save the image
-                    image_path = os.path.join(self.images_dir, f"image_{uuid.uuid4()}.png")
-                    image.save(image_path)
-                    
+                # Keep Replicate's encoding instead of re-saving as PNG
+                extension = os.path.splitext(urlparse(image_url).path)[1] or ".png"
+                image_path = f"{self._images_prefix}{next(self._seq):06d}{extension}"
+                
+                # Stream the image to disk
+                if await self._download(image_url, image_path):
                     status_placeholder.write("✅ Image generated successfully with Replicate")
-                    return image, image_path
+                    return image_path
                 else:
                     status_placeholder.write(f"❌ Failed to download image from URL")
-                    return None, None
+                    return None
             else:
                 status_placeholder.write("❌ No image URL returned from Replicate")
-                return None, None
+                return None
         except Exception as e:
             status_placeholder.write(f"❌ Error generating image: {str(e)}")
-            return None, None
+            return None
+    
+    async def _download(self, url, path):
+        session = self._get_session()
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT)) as response:
+            if response.status != 200:
+                return False
+            # Stream into a .part file and move it into place only once complete
+            part_path = path + ".part"
+            try:
+                with open(part_path, "wb") as f:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                os.replace(part_path, path)
+            except BaseException:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
+            return True
+    
+    async def describe_image(self, image_path, status_placeholder, output_slot=None):
+        # Hash the file off the event loop, other loops may be running
+        digest = await asyncio.get_running_loop().run_in_executor(None, file_sha1, image_path)
+        key = "describe:" + digest
+        return await self._cached(
+            key,
+            lambda: self._describe_image_with_replicate(image_path, status_placeholder, output_slot),
+            status_placeholder,
+        )
     
-    def describe_image(self, image, status_placeholder):
+    async def _describe_image_with_replicate(self, image_path, status_placeholder, output_slot=None):
         status_placeholder.write("Generating description from image using Replicate...")
         
         try:
-            # Save image temporarily to upload to Replicate
-            temp_image_path = os.path.join(self.images_dir, f"temp_{uuid.uuid4()}.png")
-            image.save(temp_image_path)
+            # Downscale to a small JPEG before uploading, off the event loop
+            image_file = await asyncio.get_running_loop().run_in_executor(None, thumbnail_jpeg, image_path)
             
-            # Using LLaVA on Replicate for image description
-            output = replicate.run(
-                "yorickvp/llava-13b:2facb4a474a0462c15041b78b1ad70952ea46b5ec6ad29583c0b29dbd4249591",
-                input={
-                    "image": open(temp_image_path, "rb"),
-                    "prompt": "Describe this image in detail as if you were creating a prompt for an image generator. Be creative and focus on visual elements, style, mood, and atmosphere. Do not start with phrases like 'This image shows' or 'I can see'. Just describe the content directly."
-                }
-            )
-            
-            # Clean up temporary file
-            os.remove(temp_image_path)
-            
-            # Replicate returns output as a generator, collect all parts
-            result = ""
-            for item in output:
-                result += item
-                
-            description = result.strip()
-            
-            # Save the description
-            description_path = os.path.join(self.prompts_dir, f"description_{uuid.uuid4()}.txt")
-            with open(description_path, "w", encoding="utf-8") as f:
-                f.write(description)
+            # Using LLaVA on Replicate for image description, streamed into the UI
+            tokens = self._stream_replicate(LLAVA_MODEL, {"image": image_file, "prompt": DESCRIBE_PROMPT})
+            description = await render_stream(tokens, output_slot)
             
             status_placeholder.write("✅ Image description generated successfully")
             return description
         except Exception as e:
             status_placeholder.write(f"❌ Error describing image: {str(e)}")
             return None
+    
+    async def run_one_loop(self, prompt, iterations, seed, container):
+        # Render through the container's methods so concurrent loops don't share a `with` context
+        current_prompt = prompt
+        previous_signature = None
+        
+        # Pre-allocate every iteration's placeholders once and fill them in place
+        iteration_slots = [
+            {name: container.empty() for name in ITERATION_SLOTS}
+            for _ in range(iterations)
+        ]
+        history = st.session_state.setdefault("history", [])
+        
+        for i, slots in enumerate(iteration_slots):
+            slots["title"].markdown(f"<h2>Iteration {i+1}</h2>", unsafe_allow_html=True)
+            
+            # Prompt Expansion
+            slots["expand_header"].markdown("<div class='step-header'>Step 1: Expanding Prompt</div>", unsafe_allow_html=True)
+            expanded_prompt = await self.expand_prompt(current_prompt, slots["expand_status"], slots["expand_output"])
+            self.log_event(i + 1, "expand", expanded_prompt, seed)
+            slots["expand_output"].markdown(f"<div class='output-area'>{expanded_prompt}</div>", unsafe_allow_html=True)
+            
+            # Image Generation
+            slots["image_header"].markdown("<div class='step-header'>Step 2: Generating Image</div>", unsafe_allow_html=True)
+            image_path = await self.generate_image(expanded_prompt, slots["image_status"], seed)
+            if image_path:
+                self.log_event(i + 1, "image", image_path, seed)
+                
+                # Streamlit reads the file itself, no decode in the app process
+                slots["image_output"].image(image_path, caption=f"Generated Image - Iteration {i+1} (seed {seed})", use_column_width=True)
+            
+            # Image Description
+            slots["describe_header"].markdown("<div class='step-header'>Step 3: Describing Image</div>", unsafe_allow_html=True)
+            if image_path:
+                new_prompt = await self.describe_image(image_path, slots["describe_status"], slots["describe_output"])
+                if not new_prompt:
+                    container.error("Could not describe the image. Stopping loop.")
+                    break
+                
+                self.log_event(i + 1, "describe", new_prompt, seed)
+                slots["describe_output"].markdown(f"<div class='output-area'>{new_prompt}</div>", unsafe_allow_html=True)
+                
+                history.append({
+                    "seed": seed,
+                    "iteration": i + 1,
+                    "expanded_prompt": expanded_prompt,
+                    "image_path": image_path,
+                    "description": new_prompt,
+                })
+                
+                # Update current prompt for next iteration
+                current_prompt = new_prompt
+                
+                # Stop early once descriptions stop changing
+                signature = await self._prompt_signature(new_prompt)
+                if previous_signature is not None and signature_similarity(signature, previous_signature) >= CONVERGENCE_THRESHOLD:
+                    container.info("Converged")
+                    break
+                previous_signature = signature
+            else:
+                container.error("Could not generate an image. Stopping loop.")
+                break
+            
+            # Add separator between iterations
+            if i < iterations - 1:
+                slots["separator"].markdown("<div class='iteration-separator'></div>", unsafe_allow_html=True)
+        
+        return current_prompt
+
+async def run_loops(loop, initial_prompt, iterations, num_parallel):
+    try:
+        # Start a fresh history so reruns only show the latest run
+        st.session_state["history"] = []
+        
+        # One column per seed, all loops share the same client and Replicate semaphore
+        columns = st.columns(num_parallel)
+        results = await asyncio.gather(*[
+            loop.run_one_loop(initial_prompt, iterations, 42 + n, columns[n])
+            for n in range(num_parallel)
+        ])
+        
+        st.success("Feedback loop complete!")
+        st.balloons()
+        return results
+    finally:
+        await loop.close()
+
+def render_history(history):
+    # Redraw the last run's results on reruns that don't start a new loop
+    st.markdown("<h2>Previous Run</h2>", unsafe_allow_html=True)
+    for entry in history:
+        st.markdown(f"<h3>Seed {entry['seed']} - Iteration {entry['iteration']}</h3>", unsafe_allow_html=True)
+        st.markdown(f"<div class='output-area'>{entry['expanded_prompt']}</div>", unsafe_allow_html=True)
+        if os.path.exists(entry["image_path"]):
+            st.image(entry["image_path"], caption=f"Generated Image - Iteration {entry['iteration']} (seed {entry['seed']})", use_column_width=True)
+        st.markdown(f"<div class='output-area'>{entry['description']}</div>", unsafe_allow_html=True)
 
 def main():
+    warm_ollama()
+    
     st.title("🔄 Text-Image Feedback Loop")
     
     # Add custom CSS for better appearance
@@ -214,6 +656,9 @@ def main():
     # Iterations slider
     iterations = st.slider("Number of Iterations", 1, 5, 3)
     
+    # Parallel loops slider, each loop uses its own seed
+    num_parallel = st.slider("Number of Parallel Loops", 1, 4, 1)
+    
     if st.button("Start Feedback Loop"):
         if not initial_prompt:
             st.error("Please enter an initial prompt")
@@ -231,50 +676,10 @@ def main():
         # Initialize feedback loop
         loop = FeedbackLoop(replicate_api_token=replicate_api_token)
         
-        # Results container
-        results_container = st.container()
-        
-        with results_container:
-            current_prompt = initial_prompt
-            
-            for i in range(iterations):
-                st.markdown(f"<h2>Iteration {i+1}</h2>", unsafe_allow_html=True)
-                
-                # Prompt Expansion
-                st.markdown("<div class='step-header'>Step 1: Expanding Prompt</div>", unsafe_allow_html=True)
-                status_placeholder = st.empty()
-                expanded_prompt = loop.expand_prompt(current_prompt, status_placeholder)
-                
-                with st.expander("View Expanded Prompt", expanded=True):
-                    st.markdown(f"<div class='output-area'>{expanded_prompt}</div>", unsafe_allow_html=True)
-                
-                # Image Generation
-                st.markdown("<div class='step-header'>Step 2: Generating Image</div>", unsafe_allow_html=True)
-                status_placeholder = st.empty()
-                image, image_path = loop.generate_image(expanded_prompt, status_placeholder)
-                if image:
-                    st.image(image, caption=f"Generated Image - Iteration {i+1}", use_column_width=True)
-                
-                # Image Description
-                st.markdown("<div class='step-header'>Step 3: Describing Image</div>", unsafe_allow_html=True)
-                status_placeholder = st.empty()
-                if image:
-                    new_prompt = loop.describe_image(image, status_placeholder)
-                    with st.expander("View Image Description", expanded=True):
-                        st.markdown(f"<div class='output-area'>{new_prompt}</div>", unsafe_allow_html=True)
-                    
-                    # Update current prompt for next iteration
-                    current_prompt = new_prompt
-                else:
-                    st.error("Could not generate an image. Stopping loop.")
-                    break
-                
-                # Add separator between iterations
-                if i < iterations - 1:
-                    st.markdown("<div class='iteration-separator'></div>", unsafe_allow_html=True)
-            
-            st.success("Feedback loop complete!")
-            st.balloons()
+        # Run the loop on an event loop so network waits overlap with disk I/O
+        asyncio.run(run_loops(loop, initial_prompt, iterations, num_parallel))
+    elif st.session_state.get("history"):
+        render_history(st.session_state["history"])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file